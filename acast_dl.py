@@ -4,21 +4,52 @@
 # dependencies = [
 #     "feedparser",
 #     "mutagen",
+#     "requests",
 #     "tqdm"
 # ]
 # ///
 
 import os
-import re
-import json
+import shutil
 import argparse
+import threading
 import feedparser
-from urllib.request import Request, urlopen
-from urllib.error import HTTPError, URLError
+import requests
+from concurrent.futures import ThreadPoolExecutor
 from email.utils import parsedate_to_datetime
+from requests.adapters import HTTPAdapter
 from tqdm import tqdm
+from tqdm.utils import CallbackIOWrapper
 from mutagen.id3 import ID3, APIC, COMM, TIT2, TPE1, TALB, TDRC, WOAS, ID3NoHeaderError
 
+try:
+    # Faster JSON library, used for the RSS cache when it is installed
+    from orjson import dumps as json_dumps, loads as json_loads
+except ImportError:
+    import json
+
+    def json_dumps(obj):
+        return json.dumps(obj).encode()
+
+    json_loads = json.loads
+
+# Characters not allowed in file names
+FILENAME_FORBIDDEN_CHARS = str.maketrans("", "", '\\/*?:"<>|')
+
+# Number of cover images fetched concurrently
+IMAGE_WORKERS = 2
+
+
+class DownloadCancelled(Exception):
+    pass
+
+
+def id3_padding(info):
+    # Keep whatever padding is left when the new tags fit in the existing
+    # space: shrinking the tag would move the whole audio data. Only grow it,
+    # with a little room for later edits, when they don't fit.
+    return info.padding if info.padding >= 0 else 1024
+
 
 class CachedRSSFeed:
     def __init__(self, cache_file="rss_cache.json"):
@@ -27,45 +58,145 @@ class CachedRSSFeed:
 
     def _load_cache(self):
         if os.path.exists(self.cache_file):
-            with open(self.cache_file, "r") as f:
-                self.cache = json.load(f)
+            with open(self.cache_file, "rb") as f:
+                self.cache = json_loads(f.read())
         else:
             self.cache = {}
 
     def _save_cache(self):
-        with open(self.cache_file, "w") as f:
-            json.dump(self.cache, f)
+        with open(self.cache_file, "wb") as f:
+            f.write(json_dumps(self.cache))
 
-    def fetch(self, url, user_agent):
+    def fetch(self, url, session):
         etag = self.cache.get(url, {}).get("etag")
         modified = self.cache.get(url, {}).get("modified")
 
-        feed = feedparser.parse(url, etag=etag, modified=modified, agent=user_agent)
+        headers = {}
+        if etag:
+            headers["If-None-Match"] = etag
+        if modified:
+            headers["If-Modified-Since"] = modified
+
+        try:
+            # Streamed so that only the headers are read until we know the
+            # feed has changed
+            with session.get(url, headers=headers, stream=True) as response:
+                response.raise_for_status()
+
+                # Some servers ignore conditional requests and always answer
+                # 200, compare the validators ourselves to skip the download
+                # and parsing of an unchanged feed. As in RFC 9110, the ETag
+                # wins over Last-Modified, which only has a one-second
+                # resolution and is sometimes a fixed value on CDNs.
+                response_etag = response.headers.get("ETag")
+                if etag or response_etag:
+                    unchanged = response_etag == etag
+                else:
+                    unchanged = bool(modified) and (
+                        response.headers.get("Last-Modified") == modified
+                    )
+
+                if response.status_code == 304 or unchanged:
+                    print("Feed not modified")
+                    return None
 
-        if feed.get("status") == 304:
-            print("Feed not modified")
+                content = response.content
+        except requests.RequestException as e:
+            print(f"Failed to fetch feed: {e}")
             return None
 
+        # feedparser looks headers up by their lower-case name. It is given
+        # bytes rather than the URL, so tell it where the feed comes from to
+        # resolve relative links.
+        headers = {k.lower(): v for k, v in response.headers.items()}
+        headers.setdefault("content-location", response.url)
+        feed = feedparser.parse(content, response_headers=headers)
+
         print("New episode(s) available!")
         self.cache[url] = {
-            "etag": feed.get("etag"),
-            "modified": feed.get("modified"),
+            "etag": response.headers.get("ETag"),
+            "modified": response.headers.get("Last-Modified"),
         }
         self._save_cache()
         return feed
 
 
+class DownloadRun:
+    # State shared by the episodes downloaded by one PodcastDownloader.download()
+    def __init__(self, album, default_author, image_executor, tag_executor):
+        self.album = album
+        self.default_author = default_author
+        self.image_executor = image_executor
+        self.tag_executor = tag_executor
+
+        # Episodes usually share the show cover: fetch each image URL and build
+        # its APIC frame once per run
+        self.image_cache = {}
+        self.image_lock = threading.Lock()
+
+        self.tag_futures = []
+
+        # Set on Ctrl-C so that the episodes being downloaded are abandoned
+        self.stopped = threading.Event()
+
+
 class PodcastDownloader:
-    def __init__(self, rss_url, user_agent, output_dir="podcasts"):
+    def __init__(self, rss_url, user_agent, output_dir="podcasts", jobs=4):
         self.rss_url = rss_url
         self.output_dir = output_dir
         self.user_agent = user_agent
+        self.jobs = jobs
+
+        # A single session shared by the feed, audio and image requests so that
+        # connections to the same host are kept alive and reused, which also
+        # saves a DNS lookup per request. The pools must hold a connection per
+        # worker thread, otherwise extra connections are dropped and reopened.
+        self.session = requests.Session()
+        self.session.headers["User-Agent"] = user_agent
+        adapter = HTTPAdapter(
+            pool_connections=8, pool_maxsize=max(16, jobs + IMAGE_WORKERS)
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
 
     def sanitize_filename(self, name):
-        return re.sub(r'[\\/*?:"<>|]', "", name)
+        return name.translate(FILENAME_FORBIDDEN_CHARS)
+
+    def fetch_image(self, image_url):
+        response = self.session.get(image_url)
+        response.raise_for_status()
+        return APIC(
+            encoding=3,
+            mime="image/jpeg",
+            type=3,  # cover (front)
+            desc="Cover",
+            data=response.content,
+        )
+
+    def get_image(self, run, image_url):
+        with run.image_lock:
+            future = run.image_cache.get(image_url)
+            submitted = future is None
+            if submitted:
+                future = run.image_executor.submit(self.fetch_image, image_url)
+                run.image_cache[image_url] = future
+        # Registered outside of the lock: the callback runs right away, and
+        # takes the lock, if the fetch is already done
+        if submitted:
+            future.add_done_callback(
+                lambda f: self._evict_failed_image(run, image_url, f)
+            )
+        return future
 
-    def set_metadata(self, mp3_path, metadata, image_url=None):
-        print(f"Tagging: {mp3_path}")
+    def _evict_failed_image(self, run, image_url, future):
+        # Don't keep a failed fetch around: the next episode tries again
+        if future.exception() is not None:
+            with run.image_lock:
+                if run.image_cache.get(image_url) is future:
+                    del run.image_cache[image_url]
+
+    def set_metadata(self, mp3_path, metadata, cover=None):
+        tqdm.write(f"Tagging: {mp3_path}")
 
         try:
             tags = ID3(mp3_path)
@@ -91,124 +222,204 @@ class PodcastDownloader:
         if "link" in metadata:
             tags.add(WOAS(url=metadata["link"]))
 
-        if image_url:
-            try:
-                image_data = urlopen(image_url).read()
-                tags.add(
-                    APIC(
-                        encoding=3,
-                        mime="image/jpeg",
-                        type=3,  # cover (front)
-                        desc="Cover",
-                        data=image_data,
-                    )
-                )
-            except Exception as e:
-                print(f"Failed to download or embed image: {e}")
+        if cover is not None:
+            tags.add(cover)
 
-        tags.save(mp3_path)
+        tags.save(mp3_path, padding=id3_padding)
 
     def get_audio_url(self, entry):
+        # The RSS enclosure is where the episode audio lives, fall back to
+        # scanning every link
+        for enclosure in entry.get("enclosures", []):
+            if enclosure.get("type") == "audio/mpeg":
+                return enclosure.get("href")
         for link in entry.links:
             if link.type == "audio/mpeg":
                 return link.href
         return None
 
-    def download_file(self, url, dest_path):
-        print(f"Downloading: {url}")
-
-        req = Request(url, headers={"User-Agent": self.user_agent})
-
+    def download_file(self, url, dest_path, stopped=None):
         try:
-            with urlopen(req) as response:
-                if response.status != 200:
-                    print(f"Failed to download (HTTP {response.status})")
+            with self.session.get(url, stream=True) as response:
+                if response.status_code != 200:
+                    tqdm.write(f"Failed to download (HTTP {response.status_code})")
                     return False
 
-                total_size = int(response.getheader("Content-Length", 0))
-                block_size = 8192
-                with open(dest_path, "wb") as out_file, tqdm(
+                total_size = int(response.headers.get("Content-Length", 0))
+                block_size = 1 << 18  # 256 KiB
+                with open(dest_path, "wb", buffering=1 << 20) as out_file, tqdm(
                     total=total_size,
                     unit="B",
                     unit_scale=True,
                     unit_divisor=1024,
                     bar_format="{desc} |{bar}| {percentage:3.0f}% {n_fmt}/{total_fmt}",
+                    desc=os.path.basename(dest_path),
                     initial=0,
+                    mininterval=0.25,
+                    miniters=1 << 20,
                 ) as bar:
-                    while True:
-                        buffer = response.read(block_size)
-                        if not buffer:
-                            break
-                        out_file.write(buffer)
-                        bar.update(len(buffer))
-                return True
-
-        except HTTPError as e:
-            print(f"HTTP Error {e.code}")
-        except URLError as e:
-            print(f"URL Error: {e.reason}")
+                    # Reserve the whole file up front so that it is allocated in
+                    # as few extents as possible. Skipped for encoded responses as
+                    # Content-Length is then not the size of the file.
+                    if (
+                        total_size
+                        and hasattr(os, "posix_fallocate")
+                        and not response.headers.get("Content-Encoding")
+                    ):
+                        try:
+                            os.posix_fallocate(out_file.fileno(), 0, total_size)
+                        except OSError:
+                            pass
+
+                    # Let shutil do the copy loop in C, the wrapper reports each
+                    # block read to the progress bar
+                    def update(n):
+                        if stopped is not None and stopped.is_set():
+                            raise DownloadCancelled
+                        bar.update(n)
+
+                    response.raw.decode_content = True
+                    wrapped = CallbackIOWrapper(update, response.raw, "read")
+                    shutil.copyfileobj(wrapped, out_file, length=block_size)
+
+                # tell() is the number of bytes received, before any decoding
+                received = response.raw.tell()
+                if total_size and received != total_size:
+                    tqdm.write(f"Incomplete download ({received}/{total_size} bytes)")
+                else:
+                    return True
+
+        except DownloadCancelled:
+            pass
+        except requests.RequestException as e:
+            tqdm.write(f"Request failed: {e}")
         except Exception as e:
-            print(f"Download failed: {e}")
+            tqdm.write(f"Download failed: {e}")
 
         if os.path.exists(dest_path):
             os.remove(dest_path)
         return False
 
+    def tag_file(self, part_path, file_path, metadata, image_future=None):
+        cover = None
+        if image_future is not None:
+            try:
+                cover = image_future.result()
+            except Exception as e:
+                tqdm.write(f"Failed to download image: {e}")
+
+        try:
+            self.set_metadata(part_path, metadata, cover=cover)
+            # Only complete, tagged, episodes get their final name
+            os.replace(part_path, file_path)
+        except Exception as e:
+            tqdm.write(f"Failed to tag '{part_path}': {e}")
+            return False
+        return True
+
     def download(self):
         rss = CachedRSSFeed()
-        feed = rss.fetch(self.rss_url, self.user_agent)
+        feed = rss.fetch(self.rss_url, self.session)
 
         if feed is None:
             print("No new episodes.")
             return
 
         entries = feed.entries
+        album = feed.feed.get("title", "")
+        default_author = feed.feed.get("author", "")
 
-        podcast_dir = f"{self.output_dir}/{feed.feed.get("title", "")}"
+        podcast_dir = f"{self.output_dir}/{album}"
         os.makedirs(podcast_dir, exist_ok=True)
-
-        for entry in entries:
-            published = entry.get("published", "")
+        # A single directory read instead of a stat() per episode
+        existing = {e.name for e in os.scandir(podcast_dir)}
+
+        # Episodes are independent downloads: fetch a few of them concurrently,
+        # bounded so that we don't hammer the Acast CDN. Cover images are
+        # fetched in the background while the episode itself is downloading,
+        # and tagging is done in the background so that the next episode can
+        # start downloading while the previous one is being tagged.
+        with (
+            ThreadPoolExecutor(max_workers=IMAGE_WORKERS) as image_executor,
+            ThreadPoolExecutor(max_workers=2) as tag_executor,
+            ThreadPoolExecutor(max_workers=self.jobs) as executor,
+        ):
+            run = DownloadRun(album, default_author, image_executor, tag_executor)
             try:
-                datetime = parsedate_to_datetime(published)
-                date = datetime.strftime("%F")
-            except Exception:
-                date = "unknown"
-            metadata = {
-                "title": entry.title,
-                "author": entry.get("author", feed.feed.get("author", "")),
-                "album": feed.feed.get("title", ""),
-                "date": date,
-                "description": entry.get("description", ""),
-                "link": entry.link,
-            }
-
-            image_url = entry.get("image", {}).get("href", None)
-            audio_url = self.get_audio_url(entry)
-
-            filename = f"{self.sanitize_filename(metadata.get("title", ""))}.mp3"
-            if filename == ".mp3":
-                guid = entry.get("guid", None)
-                if guid is not None:
-                    print("No title found, use GUID as filename")
-                    filename = f"{guid}.mp3"
-                else:
-                    print("No title and no episodeId, skip this episode")
-                    continue
-            file_path = os.path.join(podcast_dir, filename)
-
-            if not audio_url:
-                print(f"Skipping '{metadata.get("link")}' (no MP3 link found)")
-                continue
+                futures = []
+                for entry in entries:
+                    filename = self.get_filename(entry)
+                    if filename is None:
+                        continue
+                    file_path = os.path.join(podcast_dir, filename)
+
+                    audio_url = self.get_audio_url(entry)
+                    if not audio_url:
+                        tqdm.write(f"Skipping '{entry.get("link")}' (no MP3 link found)")
+                        continue
+
+                    # File names are claimed in feed order so that, when
+                    # episodes share a title, the first one is downloaded
+                    # whatever the scheduling of the worker threads
+                    if filename in existing:
+                        tqdm.write(f"Already exists: {file_path}")
+                        continue
+                    existing.add(filename)
+
+                    futures.append(
+                        executor.submit(self.download_entry, run, entry, file_path, audio_url)
+                    )
+                for future in futures:
+                    future.result()
+                for future in run.tag_futures:
+                    future.result()
+            except BaseException:
+                # Ctrl-C: drop the queued work and abort the downloads in
+                # progress instead of waiting for every episode to finish
+                run.stopped.set()
+                for pool in (executor, tag_executor, image_executor):
+                    pool.shutdown(wait=False, cancel_futures=True)
+                raise
+
+    def get_filename(self, entry):
+        filename = f"{self.sanitize_filename(entry.get("title", ""))}.mp3"
+        if filename == ".mp3":
+            guid = entry.get("guid", None)
+            if guid is None:
+                tqdm.write("No title and no episodeId, skip this episode")
+                return None
+            tqdm.write("No title found, use GUID as filename")
+            filename = f"{guid}.mp3"
+        return filename
+
+    def download_entry(self, run, entry, file_path, audio_url):
+        published = entry.get("published", "")
+        try:
+            date = parsedate_to_datetime(published).strftime("%F")
+        except Exception:
+            date = "unknown"
+        metadata = {
+            "title": entry.title,
+            "author": entry.get("author", run.default_author),
+            "album": run.album,
+            "date": date,
+            "description": entry.get("description", ""),
+            "link": entry.link,
+        }
 
-            if not os.path.exists(file_path):
-                if self.download_file(audio_url, file_path):
-                    self.set_metadata(file_path, metadata, image_url=image_url)
-                else:
-                    print(f"Skipping metadata for '{metadata.get("title", "")}' due to download failure.")
-            else:
-                print(f"Already exists: {file_path}")
+        image_url = entry.get("image", {}).get("href", None)
+        image_future = None
+        if image_url:
+            image_future = self.get_image(run, image_url)
 
+        part_path = f"{file_path}.part"
+        if self.download_file(audio_url, part_path, run.stopped):
+            future = run.tag_executor.submit(
+                self.tag_file, part_path, file_path, metadata, image_future
+            )
+            run.tag_futures.append(future)
+        elif not run.stopped.is_set():
+            tqdm.write(f"Skipping metadata for '{metadata.get("title", "")}' due to download failure.")
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
@@ -225,10 +436,21 @@ if __name__ == "__main__":
         default="Wget/1.25.0",
         help="Custom User-Agent header (default: Wget/1.25.0)",
     )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=4,
+        help="Number of episodes downloaded concurrently (default: 4)",
+    )
 
     args = parser.parse_args()
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1")
 
     downloader = PodcastDownloader(
-        rss_url=args.rss_url, user_agent=args.user_agent, output_dir=args.output_dir
+        rss_url=args.rss_url,
+        user_agent=args.user_agent,
+        output_dir=args.output_dir,
+        jobs=args.jobs,
     )
     downloader.download()